@@ -1,19 +1,33 @@
 import os
-import io
 import logging
-from collections import defaultdict
-import json
+import asyncio
+import threading
+import concurrent.futures
+from collections import defaultdict, OrderedDict
+from typing import Dict, List, Optional, Protocol, Set, Tuple
 from http.server import BaseHTTPRequestHandler
 
+import httpx
+import orjson
 from telegram import Update, BotCommand
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
 
 from google import genai
 from google.genai import types
-from PIL import Image
+
+from api.shared import (
+    PIL_POOL,
+    REFERENCE_MAX_EDGE,
+    SAVE_KEYWORDS_RE,
+    STYLE_TRANSFER_PROMPT,
+    get_gemini_limits,
+    prepare_subject,
+    shrink_reference,
+)
 
 try:
-    from supabase import create_client, Client
+    from supabase import acreate_client
 except ImportError:
     pass
 
@@ -29,37 +43,161 @@ logging.basicConfig(
 )
 
 if GEMINI_API_KEY:
-    gemini_client = genai.Client(api_key=GEMINI_API_KEY)
-
-# Supabase Client Initialization
-supabase = None
-if SUPABASE_URL and SUPABASE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# Helper functions for Supabase Storage
-def get_user_state(chat_id: int) -> bool:
-    if not supabase: return False
-    res = supabase.table('user_states').select('is_setting_style').eq('chat_id', str(chat_id)).execute()
-    if res.data:
-        return res.data[0].get('is_setting_style', False)
-    return False
-
-def set_user_state(chat_id: int, state: bool):
-    if not supabase: return
-    supabase.table('user_states').upsert({'chat_id': str(chat_id), 'is_setting_style': state}).execute()
-
-def get_style_files(chat_id: int):
-    if not supabase: return []
-    res = supabase.table('style_references').select('file_id').eq('chat_id', str(chat_id)).order('created_at').execute()
-    return [row['file_id'] for row in res.data]
-
-def add_style_file(chat_id: int, file_id: str):
-    if not supabase: return
-    supabase.table('style_references').insert({'chat_id': str(chat_id), 'file_id': file_id}).execute()
-
-def clear_style_files(chat_id: int):
-    if not supabase: return
-    supabase.table('style_references').delete().eq('chat_id', str(chat_id)).execute()
+    # HTTP/2 keep-alive pool so warm invocations skip the TLS handshake
+    gemini_client = genai.Client(
+        api_key=GEMINI_API_KEY,
+        http_options=types.HttpOptions(
+            async_client_args={
+                "http2": True,
+                "limits": httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            }
+        ),
+    )
+
+# Storage backends: Supabase when configured, otherwise an in-process dict
+# (state is then lost when the container is recycled)
+class Store(Protocol):
+    async def set_user_state(self, chat_id: int, state: bool) -> None: ...
+    async def get_style_files(self, chat_id: int, limit: int = 10) -> List[str]: ...
+    async def count_style_files(self, chat_id: int) -> int: ...
+    async def handle_photo(self, chat_id: int, file_id: str, force: bool) -> Tuple[bool, int]: ...
+    async def clear_style_files(self, chat_id: int) -> None: ...
+
+class SupabaseStore:
+    """Store backed by the Supabase tables, using the async client created lazily on the running event loop."""
+
+    def __init__(self, url: str, key: str):
+        self._url = url
+        self._key = key
+        self._client = None
+
+    async def _get_client(self):
+        if self._client is None:
+            self._client = await acreate_client(self._url, self._key)
+        return self._client
+
+    async def set_user_state(self, chat_id: int, state: bool) -> None:
+        supabase = await self._get_client()
+        await supabase.table('user_states').upsert({'chat_id': str(chat_id), 'is_setting_style': state}).execute()
+
+    async def get_style_files(self, chat_id: int, limit: int = 10) -> List[str]:
+        supabase = await self._get_client()
+        res = await supabase.table('style_references').select('file_id').eq('chat_id', str(chat_id)).order('created_at').limit(limit).execute()
+        return [row['file_id'] for row in res.data]
+
+    async def count_style_files(self, chat_id: int) -> int:
+        supabase = await self._get_client()
+        res = await supabase.table('style_references').select('file_id', count='exact').eq('chat_id', str(chat_id)).limit(1).execute()
+        return res.count or 0
+
+    async def handle_photo(self, chat_id: int, file_id: str, force: bool) -> Tuple[bool, int]:
+        """Save file_id as a reference if the chat is setting style (or force), in one round-trip.
+
+        Returns (is_setting_style, reference_count). See supabase/handle_photo.sql.
+        """
+        supabase = await self._get_client()
+        res = await supabase.rpc('handle_photo', {'p_chat_id': str(chat_id), 'p_file_id': file_id, 'p_force': force}).execute()
+        if res.data:
+            return res.data[0].get('is_setting', False), res.data[0].get('ref_count', 0)
+        return False, 0
+
+    async def clear_style_files(self, chat_id: int) -> None:
+        supabase = await self._get_client()
+        await supabase.table('style_references').delete().eq('chat_id', str(chat_id)).execute()
+
+class MemoryStore:
+    """Store kept in process memory, used when Supabase isn't configured."""
+
+    def __init__(self):
+        self.chat_is_setting_style = defaultdict(bool)
+        # Full list in save order, like the Supabase table: reads return the oldest `limit`
+        # references and counts report the real total
+        self.chat_styles_file_ids = defaultdict(list)
+
+    async def set_user_state(self, chat_id: int, state: bool) -> None:
+        self.chat_is_setting_style[chat_id] = state
+
+    async def get_style_files(self, chat_id: int, limit: int = 10) -> List[str]:
+        return self.chat_styles_file_ids[chat_id][:limit]
+
+    async def count_style_files(self, chat_id: int) -> int:
+        return len(self.chat_styles_file_ids[chat_id])
+
+    async def handle_photo(self, chat_id: int, file_id: str, force: bool) -> Tuple[bool, int]:
+        is_setting = self.chat_is_setting_style[chat_id]
+        if is_setting or force:
+            self.chat_styles_file_ids[chat_id].append(file_id)
+        return is_setting, len(self.chat_styles_file_ids[chat_id])
+
+    async def clear_style_files(self, chat_id: int) -> None:
+        self.chat_styles_file_ids[chat_id].clear()
+
+store: Store = SupabaseStore(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL and SUPABASE_KEY else MemoryStore()
+
+# In-memory LRU of shrunk reference JPEGs keyed by (file_id, max_edge) (file_ids are immutable),
+# so warm invocations don't re-download the same moodboard
+FILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_file_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+_file_cache_size = 0
+
+def get_cached_file(key):
+    data = _file_cache.get(key)
+    if data is not None:
+        _file_cache.move_to_end(key)
+    return data
+
+def put_cached_file(key, data: bytes):
+    global _file_cache_size
+    if key in _file_cache:
+        _file_cache_size -= len(_file_cache.pop(key))
+    _file_cache[key] = data
+    _file_cache_size += len(data)
+    while _file_cache_size > FILE_CACHE_MAX_BYTES and _file_cache:
+        _, evicted = _file_cache.popitem(last=False)
+        _file_cache_size -= len(evicted)
+
+# Telegram file_path per reference file_id, so repeated downloads of a moodboard skip the
+# getFile round-trip and fetch bytes directly over a shared keep-alive client. Telegram only
+# guarantees a path for an hour, so any failed download from a cached path (HTTP error
+# or transport error) evicts it and re-resolves it once through getFile.
+# With python-telegram-bot >= 20, File.file_path already holds the full download URL,
+# which embeds the bot token: it must never end up in logs or error replies.
+FILE_PATH_CACHE_MAX_ENTRIES = 1024
+_file_paths: "OrderedDict[str, str]" = OrderedDict()
+_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+)
+
+async def _get_telegram_url(url: str) -> httpx.Response:
+    try:
+        return await _http_client.get(url)
+    except httpx.HTTPError as e:
+        raise RuntimeError(f"Telegram file download failed ({type(e).__name__})") from None
+
+async def download_telegram_file(bot, file_id: str, cache_path: bool = False) -> bytes:
+    file_path = _file_paths.get(file_id)
+    if file_path is not None:
+        _file_paths.move_to_end(file_id)
+        try:
+            response = await _get_telegram_url(file_path)
+            if response.is_success:
+                return response.content
+        except RuntimeError:
+            pass
+        # Stale or unreachable cached path: forget it and resolve a fresh one below
+        _file_paths.pop(file_id, None)
+    file_path = (await bot.get_file(file_id)).file_path
+    if cache_path:
+        _file_paths[file_id] = file_path
+        _file_paths.move_to_end(file_id)
+        while len(_file_paths) > FILE_PATH_CACHE_MAX_ENTRIES:
+            _file_paths.popitem(last=False)
+    response = await _get_telegram_url(file_path)
+    if not response.is_success:
+        raise RuntimeError(f"Telegram file download failed (HTTP {response.status_code})")
+    return response.content
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = (
@@ -75,7 +213,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def set_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    set_user_state(chat_id, True)
+    await store.set_user_state(chat_id, True)
     await update.message.reply_text(
         "Modalità Set Style attivata! Ora inviami tutte le immagini che definiranno il 'Mood'.\n"
         "Quando hai finito, digita /done_style."
@@ -83,18 +221,18 @@ async def set_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def done_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    set_user_state(chat_id, False)
-    count = len(get_style_files(chat_id))
+    await store.set_user_state(chat_id, False)
+    count = await store.count_style_files(chat_id)
     await update.message.reply_text(f"Modalità Set Style terminata. Hai {count} immagini di referenza salvate.\nOra inviami la foto (Soggetto) che vuoi trasformare.")
 
 async def clear_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    clear_style_files(chat_id)
+    await store.clear_style_files(chat_id)
     await update.message.reply_text("Tutte le immagini di referenza sono state cancellate in modo permanente dal database.")
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
-    count = len(get_style_files(chat_id))
+    count = await store.count_style_files(chat_id)
     await update.message.reply_text(f"Attualmente hai {count} immagini di referenza salvate nel database cloud.")
 
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -104,21 +242,18 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     file_id = photo.file_id
     
     caption_text = (update.message.caption or "").strip().lower()
-    is_caption_asking_to_save = any(word in caption_text for word in ["add", "ref", "style", "salva", "mood"])
+    is_caption_asking_to_save = bool(SAVE_KEYWORDS_RE.search(caption_text))
     
-    is_setting_style = get_user_state(chat_id)
+    is_setting_style, count = await store.handle_photo(chat_id, file_id, is_caption_asking_to_save)
     
     if is_setting_style or is_caption_asking_to_save:
-        add_style_file(chat_id, file_id)
-        count = len(get_style_files(chat_id))
-        
         if is_caption_asking_to_save and not is_setting_style:
            await update.message.reply_text(f"Didascalia riconosciuta! Immagine di referenza aggiunta rapidamente nel DB. Totale referenze: {count}")
         else:
            await update.message.reply_text(f"Immagine di referenza salvata con successo nel DB. Ne hai {count} salvate.")
     else:
         # Treat as subject
-        ref_file_ids = get_style_files(chat_id)
+        ref_file_ids = await store.get_style_files(chat_id)
         if not ref_file_ids:
             await update.message.reply_text(
                 "Non hai impostato alcuna immagine di referenza per lo stile. "
@@ -129,40 +264,46 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text("Ricevuto il soggetto. Scaricando temporaneamente le immagini per Gemini... Attendi.")
         
         try:
-            # Download subject
-            subject_file = await context.bot.get_file(file_id)
-            subject_bytes = await subject_file.download_as_bytearray()
-            subject_image = Image.open(io.BytesIO(subject_bytes))
-            
-            # Download references
-            loaded_styles = []
-            for r_file_id in ref_file_ids[:10]: # limit to 10 max
-                 r_file = await context.bot.get_file(r_file_id)
-                 r_bytes = await r_file.download_as_bytearray()
-                 loaded_styles.append(Image.open(io.BytesIO(r_bytes)))
-
-            prompt = (
-                "Maintain the main subject, composition, and content of the first image perfectly intact. "
-                "Apply the exact aesthetic, mood, lighting, color grading, and style of the supplementary reference images to the main subject."
-            )
-            
-            contents = [prompt, subject_image] + loaded_styles
+            # Download subject and references (already limited to 10) concurrently,
+            # capping in-flight requests to avoid Telegram rate limiting
+            download_sem = asyncio.Semaphore(5)
+
+            async def _fetch(fid, cache_path=False):
+                async with download_sem:
+                    return await download_telegram_file(context.bot, fid, cache_path)
+
+            async def _fetch_reference(fid):
+                key = (fid, REFERENCE_MAX_EDGE)
+                data = get_cached_file(key)
+                if data is None:
+                    data = await asyncio.get_running_loop().run_in_executor(PIL_POOL, shrink_reference, await _fetch(fid, cache_path=True))
+                    put_cached_file(key, data)
+                return data
+
+            results = await asyncio.gather(_fetch(file_id), *[_fetch_reference(r) for r in ref_file_ids])
+            # Telegram photos are already JPEG: hand the bytes to Gemini, only scaling down oversized ones
+            subject_bytes = await asyncio.get_running_loop().run_in_executor(PIL_POOL, prepare_subject, results[0])
+            subject_part = types.Part.from_bytes(data=subject_bytes, mime_type="image/jpeg")
+            style_parts = [types.Part.from_bytes(data=r_bytes, mime_type="image/jpeg") for r_bytes in results[1:]]
+
+            contents = [STYLE_TRANSFER_PROMPT, subject_part] + style_parts
             
-            response = gemini_client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    image_config=types.ImageConfig(image_size="1K")
+            gemini_semaphore, gemini_rate_limiter = get_gemini_limits()
+            async with gemini_semaphore, gemini_rate_limiter:
+                response = await gemini_client.aio.models.generate_content(
+                    model="gemini-3-pro-image-preview",
+                    contents=contents,
+                    config=types.GenerateContentConfig(
+                        response_modalities=["IMAGE"],
+                        image_config=types.ImageConfig(image_size="1K")
+                    )
                 )
-            )
             
             generated_image_bytes = None
             for part in response.parts:
-                if hasattr(part, 'as_image') and (img := part.as_image()):
-                    img_byte_arr = io.BytesIO()
-                    img.save(img_byte_arr, format='PNG')
-                    generated_image_bytes = img_byte_arr.getvalue()
+                # Gemini returns encoded image bytes in inline_data: forward them without re-encoding
+                if part.inline_data and part.inline_data.data:
+                    generated_image_bytes = part.inline_data.data
                     break
             
             if generated_image_bytes:
@@ -180,13 +321,34 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 # Build telegram application globally but lazily to avoid cold start crashes
 _app = None
+_app_initialized = False
+_app_init_lock = None
+
+# Reused across warm invocations so connection pools aren't torn down per request.
+# The loop runs in a background thread shared by all concurrent webhook requests.
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="bot-event-loop", daemon=True).start()
+
+# Give up on an update before Vercel kills the function (keep below its maxDuration)
+WEBHOOK_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_TIMEOUT_SECONDS", "55"))
+
+# One queue and worker per chat: updates stay ordered within a chat while
+# different chats are processed concurrently. Each entry is (update, future) and
+# the webhook request waits on its own future before responding.
+_chat_queues: Dict[Optional[int], asyncio.Queue] = {}
+_chat_workers: Set[asyncio.Task] = set()
 
 def get_app():
     global _app
     if not _app:
         if not TELEGRAM_BOT_TOKEN:
             raise ValueError("TELEGRAM_BOT_TOKEN environment variable is missing!")
-        _app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+        _app = (
+            ApplicationBuilder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .request(HTTPXRequest(connection_pool_size=50, http_version="2"))
+            .build()
+        )
         _app.add_handler(CommandHandler("start", start))
         _app.add_handler(CommandHandler("set_style", set_style))
         _app.add_handler(CommandHandler("done_style", done_style))
@@ -195,25 +357,79 @@ def get_app():
         _app.add_handler(MessageHandler(filters.PHOTO, handle_image))
     return _app
 
+async def _chat_worker(chat_id: Optional[int], queue: asyncio.Queue):
+    current_app = get_app()
+    try:
+        while True:
+            update_obj, done = await queue.get()
+            try:
+                await current_app.process_update(update_obj)
+            except Exception as e:
+                logging.error(f"Error processing update for chat {chat_id}: {e}")
+                if not done.done():
+                    done.set_exception(e)
+            else:
+                # done may already be cancelled if the webhook request timed out
+                if not done.done():
+                    done.set_result(None)
+            finally:
+                # Always release the waiting webhook, even on cancellation
+                if not done.done():
+                    done.cancel()
+                queue.task_done()
+            # Retire idle workers so chats that went quiet don't keep a task around
+            if queue.empty():
+                return
+    finally:
+        # However the worker exits, never leave a chat pointing at a queue nobody consumes
+        if _chat_queues.get(chat_id) is queue:
+            del _chat_queues[chat_id]
+        while not queue.empty():
+            _, pending = queue.get_nowait()
+            if not pending.done():
+                pending.cancel()
+
+async def process_webhook_update(update_json: dict):
+    """Queue the update behind earlier ones from the same chat and wait until it has been processed."""
+    global _app_initialized, _app_init_lock
+    current_app = get_app()
+    if not _app_initialized:
+        # Created here so it binds to _loop rather than the importing thread's loop
+        if _app_init_lock is None:
+            _app_init_lock = asyncio.Lock()
+        async with _app_init_lock:
+            if not _app_initialized:
+                await current_app.initialize()
+                _app_initialized = True
+    update_obj = Update.de_json(update_json, current_app.bot)
+    chat_id = update_obj.effective_chat.id if update_obj.effective_chat else None
+    queue = _chat_queues.get(chat_id)
+    if queue is None:
+        queue = _chat_queues[chat_id] = asyncio.Queue()
+        task = asyncio.create_task(_chat_worker(chat_id, queue))
+        _chat_workers.add(task)
+        task.add_done_callback(_chat_workers.discard)
+    done = asyncio.get_running_loop().create_future()
+    await queue.put((update_obj, done))
+    await done
+
 # Setup logic for Vercel Serverless Function
 class handler(BaseHTTPRequestHandler):
     def do_POST(self):
         try:
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
-            update_json = json.loads(post_data.decode('utf-8'))
-            
-            # Since Vercel executes this synchronously per request, we need an event loop 
-            # to process the Telegram Update async object.
-            import asyncio
-            
-            async def process_update():
-                current_app = get_app()
-                await current_app.initialize()
-                update_obj = Update.de_json(update_json, current_app.bot)
-                await current_app.process_update(update_obj)
+            update_json = orjson.loads(post_data)
             
-            asyncio.run(process_update())
+            # Run the update on the shared background loop and respond only once it is done:
+            # Vercel freezes the function after the response, so no work may outlive it.
+            # Concurrent requests for other chats proceed in parallel on the same loop.
+            future = asyncio.run_coroutine_threadsafe(process_webhook_update(update_json), _loop)
+            try:
+                future.result(timeout=WEBHOOK_TIMEOUT_SECONDS)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise
             
             self.send_response(200)
             self.end_headers()
@@ -0,0 +1,73 @@
+import io
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiolimiter import AsyncLimiter
+from PIL import Image
+
+# Helpers shared by the polling bot (main.py) and the Vercel webhook (api/index.py)
+
+# Caption keywords that mark a photo as a style reference, matched in a single pass
+SAVE_KEYWORDS_RE = re.compile(r"add|ref|style|salva|mood")
+
+STYLE_TRANSFER_PROMPT = (
+    "Maintain the main subject, composition, and content of the first image perfectly intact. "
+    "Apply the exact aesthetic, mood, lighting, color grading, and style of the supplementary reference images to the main subject."
+)
+
+# Gemini image models allow very few concurrent requests: queue bursts locally
+# instead of letting them fail with 429 after uploading the whole payload
+_gemini_limits = None
+
+def get_gemini_limits():
+    """Return the shared (semaphore, rate limiter) pair for Gemini calls.
+
+    Created on first use from inside the running event loop, since on Python 3.9
+    asyncio primitives bind to the loop that is current when they are built.
+    """
+    global _gemini_limits
+    if _gemini_limits is None:
+        _gemini_limits = (asyncio.Semaphore(2), AsyncLimiter(10, 60))
+    return _gemini_limits
+
+# Shared pool for blocking PIL decode/encode work so it doesn't stall the event loop
+PIL_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Gemini conditions on the overall aesthetic, not fine detail, so references are sent downsized
+REFERENCE_MAX_EDGE = 1024
+
+# Gemini renders at image_size="1K", so a full-resolution subject decode is wasted work
+SUBJECT_MAX_EDGE = 1024
+
+def shrink_reference(data: bytes, max_edge: int = REFERENCE_MAX_EDGE) -> bytes:
+    """Downsize a reference image to at most max_edge pixels per side and return it as JPEG bytes.
+
+    Small JPEGs are returned untouched; the image is closed before returning.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format == "JPEG" and max(img.size) <= max_edge:
+            return data
+        # Let libjpeg decode at a reduced scale before the final Lanczos resize
+        img.draft("RGB", (max_edge, max_edge))
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        out = io.BytesIO()
+        img.convert("RGB").save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+def prepare_subject(data: bytes, max_edge: int = SUBJECT_MAX_EDGE) -> bytes:
+    """Return the subject JPEG reduced with libjpeg's scaled decode when it is much larger than max_edge.
+
+    Photos that can't be reduced by at least half are returned as-is without decoding pixels.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format != "JPEG":
+            return data
+        # draft() only picks a scale both sides allow, so compare sizes rather than guessing
+        original_size = img.size
+        img.draft("RGB", (max_edge, max_edge))
+        if img.size == original_size:
+            return data
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=92)
+    return out.getvalue()
@@ -1,6 +1,7 @@
 import os
-import io
 import logging
+import asyncio
+import time
 from collections import defaultdict
 import glob
 from dotenv import load_dotenv
@@ -11,7 +12,15 @@ from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, Messa
 
 from google import genai
 from google.genai import types
-from PIL import Image
+
+from api.shared import (
+    PIL_POOL,
+    SAVE_KEYWORDS_RE,
+    STYLE_TRANSFER_PROMPT,
+    get_gemini_limits,
+    prepare_subject,
+    shrink_reference,
+)
 
 # Load environment variables
 load_dotenv()
@@ -37,14 +46,48 @@ os.makedirs(STYLES_DIR, exist_ok=True)
 # Chat ID -> boolean (whether the user is currently expected to send style images)
 chat_is_setting_style = defaultdict(bool)
 
+def get_manifest_path(chat_id: int) -> str:
+    """Path of the per-chat index listing the saved style image filenames, one per line."""
+    return os.path.join(STYLES_DIR, f"{chat_id}.idx")
+
 def get_style_images(chat_id: int):
-    """Retrieve all saved style images for a given chat_id from disk."""
-    patterns = [os.path.join(STYLES_DIR, f"{chat_id}_*.jpg"), 
-                os.path.join(STYLES_DIR, f"{chat_id}_*.png")]
-    files = []
-    for p in patterns:
-        files.extend(glob.glob(p))
-    return sorted(files)
+    """Retrieve all saved style images for a given chat_id from its manifest."""
+    manifest = get_manifest_path(chat_id)
+    try:
+        with open(manifest) as f:
+            names = f.read().splitlines()
+    except FileNotFoundError:
+        # Chats seen before the manifest existed: build it once from a directory scan,
+        # writing it even when empty so later lookups never scan again
+        patterns = [os.path.join(STYLES_DIR, f"{chat_id}_*.jpg"), 
+                    os.path.join(STYLES_DIR, f"{chat_id}_*.png")]
+        files = []
+        for p in patterns:
+            files.extend(glob.glob(p))
+        names = sorted(os.path.basename(f) for f in files)
+        with open(manifest, "w") as f:
+            f.writelines(name + "\n" for name in names)
+    return [os.path.join(STYLES_DIR, name) for name in names]
+
+def count_style_images(chat_id: int) -> int:
+    """Count saved style images for a given chat_id without touching the image files."""
+    return len(get_style_images(chat_id))
+
+def add_style_image(chat_id: int, filename: str):
+    """Register a newly saved style image in the chat's manifest."""
+    manifest = get_manifest_path(chat_id)
+    if not os.path.exists(manifest):
+        # The directory scan picks up the file we just saved along with any older ones
+        get_style_images(chat_id)
+        return
+    with open(manifest, "a") as f:
+        f.write(os.path.basename(filename) + "\n")
+
+def load_style_part(path: str) -> types.Part:
+    """Read a saved style image from disk as a Gemini part, downsized by shrink_reference."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return types.Part.from_bytes(data=shrink_reference(data), mime_type="image/jpeg")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
@@ -73,7 +116,7 @@ async def done_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     """Stop receiving style reference images."""
     chat_id = update.message.chat_id
     chat_is_setting_style[chat_id] = False
-    count = len(get_style_images(chat_id))
+    count = count_style_images(chat_id)
     await update.message.reply_text(f"Modalità Set Style terminata. Hai {count} immagini di referenza salvate pronte per essere usate sempre.\nOra inviami la foto (Soggetto) che vuoi trasformare.")
 
 async def clear_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -85,12 +128,14 @@ async def clear_style(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             os.remove(f)
         except Exception as e:
             logging.error(f"Errore rimozione file {f}: {e}")
+    # Truncate rather than delete: a missing manifest means "legacy chat, scan once"
+    open(get_manifest_path(chat_id), "w").close()
     await update.message.reply_text("Tutte le immagini di referenza permanenti sono state cancellate. Non ne hai più salvate in memoria.")
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Check how many style images are saved."""
     chat_id = update.message.chat_id
-    count = len(get_style_images(chat_id))
+    count = count_style_images(chat_id)
     if count == 0:
          await update.message.reply_text(f"Attualmente NON hai immagini di referenza salvate in memoria. Usa /set_style prima di inviare foto da alterare.")
     else:
@@ -104,20 +149,19 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     photo_file = await update.message.photo[-1].get_file()
     photo_bytes = await photo_file.download_as_bytearray()
     
-    # Convert to PIL Image
-    image = Image.open(io.BytesIO(photo_bytes))
-    
     caption_text = (update.message.caption or "").strip().lower()
-    is_caption_asking_to_save = any(word in caption_text for word in ["add", "ref", "style", "salva", "mood"])
+    is_caption_asking_to_save = bool(SAVE_KEYWORDS_RE.search(caption_text))
     
     if chat_is_setting_style[chat_id] or is_caption_asking_to_save:
         # Save as style reference
-        import time
         ts = int(time.time() * 1000)
         filename = os.path.join(STYLES_DIR, f"{chat_id}_{ts}.jpg")
-        image.save(filename, format='JPEG')
+        # Telegram photos are already JPEG, so write the bytes as-is instead of re-encoding
+        with open(filename, 'wb') as f:
+            f.write(bytes(photo_bytes))
+        add_style_image(chat_id, filename)
         
-        count = len(get_style_images(chat_id))
+        count = count_style_images(chat_id)
         
         if is_caption_asking_to_save and not chat_is_setting_style[chat_id]:
            await update.message.reply_text(f"Didascalia riconosciuta! Immagine di referenza aggiunta rapidamente. Totale referenze: {count}")
@@ -137,44 +181,42 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         await update.message.reply_text("Ricevuto il soggetto. Sto generando la nuova immagine con l'API Gemini. Attendi per favore...")
         
         try:
-            # Prepare Gemini request
-            prompt = (
-                "Maintain the main subject, composition, and content of the first image perfectly intact. "
-                "Apply the exact aesthetic, mood, lighting, color grading, and style of the supplementary reference images to the main subject."
-            )
-            
             # The order usually dictates how Gemini interprets them depending on the prompt logic. 
             # We explicitly tell it: first image = subject, rest = reference.
-            loaded_styles = [Image.open(f) for f in style_files]
-            
             # Gemini has a 14 reference images hardcoded limit in Python API arrays. Let's cap max styles injected here to 14.
             # Otherwise we'll hit another error. The prompt states "Up to 14 reference images" in the documentation.
-            if len(loaded_styles) > 10: # leave room for subject (1) + breathing room
-               loaded_styles = loaded_styles[:10]
+            if len(style_files) > 10: # leave room for subject (1) + breathing room
+               style_files = style_files[:10]
                await update.message.reply_text("Hai più di 10 referenze salvate. Uso le prime 10 per non sovraccaricare il modello Gemini, tranquillo il mood è preservato.")
 
-            contents = [prompt, image] + loaded_styles
+            # Pass the JPEG bytes straight to Gemini, only scaling down oversized ones
+            loop = asyncio.get_running_loop()
+            subject_bytes = await loop.run_in_executor(PIL_POOL, prepare_subject, bytes(photo_bytes))
+            subject_part = types.Part.from_bytes(data=subject_bytes, mime_type="image/jpeg")
+            style_parts = await asyncio.gather(*[loop.run_in_executor(PIL_POOL, load_style_part, f) for f in style_files])
+
+            contents = [STYLE_TRANSFER_PROMPT, subject_part] + list(style_parts)
             
             # Call Gemini
-            response = gemini_client.models.generate_content(
-                model="gemini-3-pro-image-preview",
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"], # we only want image back
-                    image_config=types.ImageConfig(
-                        # aspect_ratio="1:1",  # let it infer from subject if possible, or omit
-                        image_size="1K" # 1K resolution to avoid taking too much time
+            gemini_semaphore, gemini_rate_limiter = get_gemini_limits()
+            async with gemini_semaphore, gemini_rate_limiter:
+                response = await gemini_client.aio.models.generate_content(
+                    model="gemini-3-pro-image-preview",
+                    contents=contents,
+                    config=types.GenerateContentConfig(
+                        response_modalities=["IMAGE"], # we only want image back
+                        image_config=types.ImageConfig(
+                            # aspect_ratio="1:1",  # let it infer from subject if possible, or omit
+                            image_size="1K" # 1K resolution to avoid taking too much time
+                        )
                     )
                 )
-            )
             
             generated_image_bytes = None
             for part in response.parts:
-                if hasattr(part, 'as_image') and (img := part.as_image()):
-                    # Save the image to bytes
-                    img_byte_arr = io.BytesIO()
-                    img.save(img_byte_arr, format='PNG')
-                    generated_image_bytes = img_byte_arr.getvalue()
+                # Gemini returns encoded image bytes in inline_data: forward them without re-encoding
+                if part.inline_data and part.inline_data.data:
+                    generated_image_bytes = part.inline_data.data
                     break
             
             if generated_image_bytes:
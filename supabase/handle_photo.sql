@@ -0,0 +1,25 @@
+-- Saves an incoming photo as a style reference when the chat is in "set style"
+-- mode (or the caption asked for it) and returns the chat state plus the
+-- reference count in a single round-trip.
+create or replace function handle_photo(p_chat_id text, p_file_id text, p_force boolean default false)
+returns table (is_setting boolean, ref_count integer)
+language plpgsql
+as $$
+declare
+    v_is_setting boolean;
+begin
+    select coalesce(us.is_setting_style, false) into v_is_setting
+    from user_states us
+    where us.chat_id = p_chat_id;
+    v_is_setting := coalesce(v_is_setting, false);
+
+    if v_is_setting or p_force then
+        insert into style_references (chat_id, file_id) values (p_chat_id, p_file_id);
+    end if;
+
+    return query
+    select v_is_setting, count(*)::integer
+    from style_references sr
+    where sr.chat_id = p_chat_id;
+end;
+$$;